@@ -1,15 +1,58 @@
 #%%
-from pyspark import SparkContext
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from pyspark import SparkContext, StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import broadcast, udf, expr
-from pyspark.sql.types import FloatType, StructType, StructField, StringType
+from pyspark.sql import functions as F
+from pyspark.sql.functions import broadcast, expr
+from pyspark.sql.types import FloatType, DoubleType, LongType, StructType, StructField, StringType
 from pyspark.sql.dataframe import DataFrame
+from pyspark.sql.window import Window
 from FlightRadar24.api import FlightRadar24API
 
 
 sc = SparkContext.getOrCreate()
 spark = SparkSession(sc)
 
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+spark.conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", "64m")
+spark.conf.set("spark.sql.shuffle.partitions", "64")
+spark.conf.set("spark.sql.parquet.compression.codec", "snappy")
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+
+#%%
+
+# Schéma des objets Flight de FlightRadar24, explicite pour éviter l'inférence sur les données
+flight_schema = StructType([
+    StructField("id", StringType(), True),
+    StructField("icao_24bit", StringType(), True),
+    StructField("latitude", DoubleType(), True),
+    StructField("longitude", DoubleType(), True),
+    StructField("heading", LongType(), True),
+    StructField("altitude", LongType(), True),
+    StructField("ground_speed", LongType(), True),
+    StructField("squawk", StringType(), True),
+    StructField("aircraft_code", StringType(), True),
+    StructField("registration", StringType(), True),
+    StructField("time", LongType(), True),
+    StructField("origin_airport_iata", StringType(), True),
+    StructField("destination_airport_iata", StringType(), True),
+    StructField("number", StringType(), True),
+    StructField("airline_iata", StringType(), True),
+    StructField("on_ground", LongType(), True),
+    StructField("vertical_speed", LongType(), True),
+    StructField("callsign", StringType(), True),
+    StructField("airline_icao", StringType(), True)
+])
+
+# Colonnes des vols utilisées par les questions (callsign et number identifient le vol affiché en Q3),
+# les autres sont écartées dès le nettoyage
+flight_columns = ["id", "callsign", "number", "airline_icao", "airline_iata", "aircraft_code",
+                  "origin_airport_iata", "destination_airport_iata", "on_ground"]
+
 #%%
 def get_and_write_flights() -> DataFrame:
     """Get flights from FlightRadar24 and write them to the file"""
@@ -26,14 +69,21 @@ def get_and_write_flights() -> DataFrame:
         minute = now.minute
         second = now.second
         milisecond = now.microsecond // 10_000
-        return f"Flights/rawzone/tech_year={year}/tech_month={year}-{month}/tech_day={year}-{month}-{day}/flights{year}{month}{day}{hour}{minute}{second}{milisecond}.csv"
+        return f"Flights/rawzone/tech_year={year}/tech_month={year}-{month}/tech_day={year}-{month}-{day}/flights{year}{month}{day}{hour}{minute}{second}{milisecond}"
 
 
     fr_api = FlightRadar24API()
     flights = fr_api.get_flights()
 
-    df = spark.createDataFrame(flights)
-    df.coalesce(1).write.csv(get_file_name(), mode='overwrite', header=True, sep=';')
+    # Passage par pandas pour que le transfert vers la JVM se fasse avec Arrow
+    pdf = pd.DataFrame([flight.__dict__ for flight in flights], columns=flight_schema.fieldNames())
+    for field in flight_schema.fields:
+        if field.dataType != StringType():
+            # L'API remplace les valeurs manquantes par "N/A"
+            pdf[field.name] = pd.to_numeric(pdf[field.name], errors="coerce")
+
+    df = spark.createDataFrame(pdf, schema=flight_schema)
+    df.write.parquet(get_file_name(), mode='overwrite')
     return df
 
 #%%
@@ -43,6 +93,7 @@ def clean_dataframe(df: DataFrame) -> DataFrame:
 
     df = df.filter(~df.destination_airport_iata.isin(["NaN", "N/A"]))
     df = df.filter(~df.origin_airport_iata.isin(["NaN", "N/A"]))
+    df = df.select(flight_columns)
     
     return df
 
@@ -50,30 +101,6 @@ def clean_dataframe(df: DataFrame) -> DataFrame:
 
 def add_distance_dataframe(df: DataFrame) -> DataFrame:
     """Add details to dataframe"""
-    from math import sin, cos, sqrt, atan2, radians
-    def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-        """Calculate distance between two points"""
-        if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
-            return -1
-        # approximate radius of earth in km
-        R = 6373.0
-
-        lat1 = radians(lat1)
-        lon1 = radians(lon1)
-        lat2 = radians(lat2)
-        lon2 = radians(lon2)
-
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-
-        a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-        distance = R * c
-        return distance
-    
-    distance_udf = udf(distance, FloatType())
-
     df_airport = spark.read.csv("airports.csv", header=True, sep=',')
     df_airport = df_airport.drop("id", "ident", "type", "name", "elevation_ft", "iso_region", "municipality", "scheduled_service", "gps_code", "local_code", "home_link", "wikipedia_link", "keywords", "iso_country")
 
@@ -81,6 +108,11 @@ def add_distance_dataframe(df: DataFrame) -> DataFrame:
 
     df_airport = df_airport.withColumn("latitude_deg", df_airport["latitude_deg"].cast("float"))
     df_airport = df_airport.withColumn("longitude_deg", df_airport["longitude_deg"].cast("float"))
+
+    # Le csv n'est parsé qu'une fois pour les deux jointures (origine et destination).
+    # Pas d'unpersist ici: les jointures sont paresseuses et liraient à nouveau le csv.
+    df_airport = df_airport.select("iata_code", "latitude_deg", "longitude_deg", "continent").cache()
+    df_airport.count()
     
     df_airport_destination = df_airport.withColumnRenamed("iata_code", "destination_airport_iata")\
                                        .withColumnRenamed("latitude_deg", "destination_latitude_deg")\
@@ -95,17 +127,33 @@ def add_distance_dataframe(df: DataFrame) -> DataFrame:
     df = df.join(broadcast(df_airport_destination), ["destination_airport_iata"], how='left')
     df = df.join(broadcast(df_airport_origin), ["origin_airport_iata"], how='left')
 
-    df = df.withColumn("distance", distance_udf(df.origin_latitude_deg, df.origin_longitude_deg, df.destination_latitude_deg, df.destination_longitude_deg))
+    # Haversine évaluée par Catalyst (pas de UDF python), rayon approximatif de la terre en km
+    R = 6373.0
+    lat1 = F.radians("origin_latitude_deg")
+    lon1 = F.radians("origin_longitude_deg")
+    lat2 = F.radians("destination_latitude_deg")
+    lon2 = F.radians("destination_longitude_deg")
+
+    a = F.pow(F.sin((lat2 - lat1) / 2), 2) + F.cos(lat1) * F.cos(lat2) * F.pow(F.sin((lon2 - lon1) / 2), 2)
+    distance = F.lit(2 * R) * F.asin(F.sqrt(a))
+
+    has_null_coordinates = F.col("origin_latitude_deg").isNull() | F.col("origin_longitude_deg").isNull()\
+                         | F.col("destination_latitude_deg").isNull() | F.col("destination_longitude_deg").isNull()
+
+    df = df.withColumn("distance", F.when(has_null_coordinates, F.lit(-1.0)).otherwise(distance).cast(FloatType()))
     
     return df
 
 
 def add_aircrafts_dataframe(df: DataFrame) -> DataFrame:
     """Add aircrafts to dataframe"""
-    df_aircrafts = spark.read.csv("planes.dat", header=False, sep=',')
-    df_aircrafts = df_aircrafts.drop("_c1")
-    df_aircrafts = df_aircrafts.withColumnRenamed("_c0", "aircraft_name")\
-                               .withColumnRenamed("_c2", "aircraft_code")
+    planes_schema = StructType([
+        StructField("aircraft_name", StringType(), True),
+        StructField("aircraft_iata", StringType(), True),
+        StructField("aircraft_code", StringType(), True)
+    ])
+    df_aircrafts = spark.read.csv("planes.dat", header=False, sep=',', schema=planes_schema)
+    df_aircrafts = df_aircrafts.select("aircraft_name", "aircraft_code")
     df_aircrafts = df_aircrafts.filter(df_aircrafts.aircraft_code.isNotNull())
     
     df = df.join(broadcast(df_aircrafts), df.aircraft_code == df_aircrafts.aircraft_code, how='left')
@@ -113,16 +161,37 @@ def add_aircrafts_dataframe(df: DataFrame) -> DataFrame:
 
 def add_airlines_dataframe(df: DataFrame) -> DataFrame:
     """Add airlines to dataframe"""
-    df_airlines = spark.read.csv("airlines.dat", header=False, sep=',')
-    df_airlines = df_airlines.select("_c1","_c3", "_c4")
-    df_airlines = df_airlines.withColumnRenamed("_c1", "airline_name")\
-                             .withColumnRenamed("_c3", "airline_iata")\
-                             .withColumnRenamed("_c4", "airline_icao")
-    
-    df_airlines = df_airlines.filter(df_airlines.airline_iata.isNotNull() | df_airlines.airline_icao.isNotNull())
-
-    df = df.join(broadcast(df_airlines), [(df.airline_icao == df_airlines.airline_icao) | (df.airline_iata == df_airlines.airline_iata)], how='left')
-    df = df.drop("airline_icao").drop("airline_iata")
+    airlines_schema = StructType([
+        StructField("airline_id", StringType(), True),
+        StructField("airline_name", StringType(), True),
+        StructField("airline_alias", StringType(), True),
+        StructField("airline_iata", StringType(), True),
+        StructField("airline_icao", StringType(), True),
+        StructField("airline_callsign", StringType(), True),
+        StructField("airline_country", StringType(), True),
+        StructField("airline_active", StringType(), True)
+    ])
+    df_airlines = spark.read.csv("airlines.dat", header=False, sep=',', schema=airlines_schema)
+    df_airlines = df_airlines.select("airline_id", "airline_name", "airline_iata", "airline_icao", "airline_active")
+
+    def get_airline_by_code(code: str, name: str) -> DataFrame:
+        """Get one airline per code, preferring active airlines then the most recently added one"""
+        # "N/A" est aussi la valeur manquante des vols FlightRadar24, \N celle d'openflights
+        df_code = df_airlines.filter(df_airlines[code].isNotNull() & ~df_airlines[code].isin(["N/A", "\\N"]))
+        airline = F.struct((df_code.airline_active == "Y").alias("is_active"),
+                           df_code.airline_id.cast("int").alias("airline_id"),
+                           df_code.airline_name.alias("airline_name"))
+        return df_code.groupBy(code).agg(F.max(airline)["airline_name"].alias(name))
+
+    # Deux jointures par égalité (hash join diffusé) au lieu d'une condition OR qui force un nested loop join.
+    # Une compagnie par code pour ne pas dupliquer les vols, le code ICAO est prioritaire sur le code IATA.
+    df_airlines_icao = get_airline_by_code("airline_icao", "airline_name_icao")
+    df_airlines_iata = get_airline_by_code("airline_iata", "airline_name_iata")
+
+    df = df.join(broadcast(df_airlines_icao), ["airline_icao"], how='left')
+    df = df.join(broadcast(df_airlines_iata), ["airline_iata"], how='left')
+    df = df.withColumn("airline_name", F.coalesce("airline_name_icao", "airline_name_iata"))
+    df = df.drop("airline_name_icao", "airline_name_iata", "airline_icao", "airline_iata")
     
     return df
 
@@ -145,195 +214,170 @@ df = add_distance_dataframe(df)
 df = add_aircrafts_dataframe(df)
 df = add_airlines_dataframe(df)
 
+# Matérialisation unique du dataframe enrichi, réutilisé par toutes les questions
+df = df.persist(StorageLevel.MEMORY_AND_DISK)
+df.count()
+
+# Le filtre des vols actifs reste après l'enrichissement: Q4, Q6 et QB utilisent aussi les vols au sol enrichis,
+# filtrer avant obligerait à refaire les jointures des vols actifs alors qu'ils sont lus ici depuis le cache
 df_active = get_active_flights(df)
+df_active = df_active.persist(StorageLevel.MEMORY_AND_DISK)
+df_active.count()
 
 #%%
 
-schema = StructType([
-    StructField("continent_name", StringType(), True),
-    StructField("continent", StringType(), True)
-])
-
 data = [("North America", "NA"), 
         ("South America", "SA"), 
         ("Europe", "EU"), 
         ("Asia", "AS"), 
         ("Africa", "AF"), 
         ("Australia", "OC")]
-df_continent = broadcast(spark.createDataFrame(data, schema))
 
-#%%
+# Nom des continents résolu par une map littérale, sans jointure
+continent_map = F.create_map(*[F.lit(value) for continent_name, continent in data for value in (continent, continent_name)])
 
-# Q1: La compagnie avec le + de vols en cours
+#%%
 
-df_active.createOrReplaceTempView("df_active")
+# Base commune Q1/Q2: une seule agrégation de df_active, Q1 et Q2 sont déduites du résultat réduit
 
-df_q1 = spark.sql("""SELECT airline_name, COUNT(airline_name) AS nb_flights 
-                                 FROM df_active 
-                                 GROUP BY airline_name 
-                                 ORDER BY nb_flights DESC 
-                                 LIMIT 1""")
+# Les compagnies inconnues sont écartées avant l'agrégation pour compter avec count(*) comme avec count(airline_name)
+df_q2_base = df_active.filter(df_active.airline_name.isNotNull())\
+                      .groupBy("origin_airport_continent", "destination_airport_continent", "airline_name")\
+                      .agg(F.count(F.lit(1)).alias("number_of_flights"))
+df_q2_base.cache()
+df_q2_base.count()
 
 #%%
 
-# Q2: Pour chaque continent, la compagnie avec le + de vols régionaux actifs
-
-df_q2 = df_active.groupBy("origin_airport_continent", "destination_airport_continent", "airline_name")\
-          .agg({"airline_name": "count"})\
-          .orderBy("count(airline_name)", ascending=False)\
-          .filter(df_active.origin_airport_continent == df_active.destination_airport_continent)
-
-df_q2 = df_q2.withColumnRenamed("count(airline_name)", "number_of_flights")\
-             .drop("origin_airport_continent")\
-             .withColumnRenamed("destination_airport_continent", "continent")
+# Q1: La compagnie avec le + de vols en cours
 
+df_q1 = df_q2_base.groupBy("airline_name")\
+                  .agg(F.sum("number_of_flights").alias("nb_flights"))\
+                  .orderBy(F.desc("nb_flights"))\
+                  .limit(1)
 
-df_q2.createOrReplaceTempView("df_q2")
+#%%
 
+# Q2: Pour chaque continent, la compagnie avec le + de vols régionaux actifs
 
-df_q2 = spark.sql("""
-    SELECT continent, airline_name, number_of_flights
-    FROM (
-        SELECT continent, airline_name, number_of_flights,
-        ROW_NUMBER() OVER (PARTITION BY continent ORDER BY number_of_flights DESC) AS row_number
-        FROM df_q2
-    )
-    WHERE row_number = 1
-""")
+# max_by ne garde que la compagnie du maximum en une seule réduction, sans trier chaque continent
+df_q2 = df_q2_base.filter(df_q2_base.origin_airport_continent == df_q2_base.destination_airport_continent)\
+                  .groupBy("destination_airport_continent")\
+                  .agg(expr("max_by(airline_name, number_of_flights)").alias("airline_name"),
+                       F.max("number_of_flights").alias("number_of_flights"))\
+                  .withColumnRenamed("destination_airport_continent", "continent")
 
-df_q2 = df_q2.join(df_continent, df_q2.continent == df_continent.continent, how='left')             
+df_q2 = df_q2.withColumn("continent_name", continent_map[df_q2.continent])
 df_q2 = df_q2.drop("continent")
 
 #%%
 
 # Q3: Le vol en cours avec le trajet le plus long
 
-df_q3 = spark.sql("""
-    SELECT * FROM df_active
-    WHERE distance = (SELECT MAX(distance) FROM df_active)
-""")
+# Un seul parcours de df_active: limit(1) après le tri devient un top-1 partiel par partition
+df_q3 = df_active.orderBy(F.desc("distance")).limit(1)
 
 #%%
 
 # Q4: Pour chaque continent, la longueur de vol moyenne 
 
-df.createOrReplaceTempView("df")
-
-df_q4 = spark.sql("""
-    SELECT origin_airport_continent, AVG(distance) AS distance_mean
-    FROM df
-    WHERE distance > 0
-    GROUP BY origin_airport_continent
-""")
+df_q4 = df.filter(df.distance > 0)\
+          .groupBy("origin_airport_continent")\
+          .agg(F.avg("distance").alias("distance_mean"))
 
-df_q4 = df_q4.join(df_continent, df_q4.origin_airport_continent == df_continent.continent, how='left')
-df_q4 = df_q4.drop("origin_airport_continent", "continent")
+df_q4 = df_q4.withColumn("continent_name", continent_map[df_q4.origin_airport_continent])
+df_q4 = df_q4.drop("origin_airport_continent")
 
 #%%
 
 # Q5: L'entreprise constructeur d'avions avec le plus de vols actifs
 
-df_q5 = df_active.groupBy("aircraft_name")\
-            .agg({"aircraft_name": "count"})\
-            .orderBy("count(aircraft_name)", ascending=False)\
-            .limit(1)
-
-df_q5 = df_q5.withColumnRenamed("count(aircraft_name)", "number_of_flights")\
-                .withColumnRenamed("aircraft_name", "aircraft")
+# Pas de tri global: max_by récupère l'avion le plus fréquent dans la même étape que l'agrégation
+df_q5 = df_active.filter(df_active.aircraft_name.isNotNull())\
+            .groupBy("aircraft_name")\
+            .agg(F.count(F.lit(1)).alias("count"))\
+            .agg(expr("max_by(aircraft_name, count)").alias("aircraft"),
+                 F.max("count").alias("number_of_flights"))
 
 #%%
 
 # Q6: Pour chaque pays de compagnie aérienne, le top 3 des modèles d'avion en usage
 
-df_q6 = df.groupBy("airline_name", "aircraft_name")\
-          .agg({"airline_name": "count"})\
-          .orderBy("count(airline_name)", ascending=False)\
-          .filter(df.airline_name.isNotNull())\
-          .filter(df.aircraft_name.isNotNull())
-
-df_q6 = df_q6.withColumnRenamed("count(airline_name)", "number_of_flights")
+df_q6 = df.filter(df.airline_name.isNotNull() & df.aircraft_name.isNotNull())\
+          .groupBy("airline_name", "aircraft_name")\
+          .agg(F.count(F.lit(1)).alias("number_of_flights"))
 
-df_q6.createOrReplaceTempView("df_q6")
+# Top 3 par compagnie sans tri par fenêtre: tri décroissant des (nombre de vols, avion) collectés puis découpe
+df_q6 = df_q6.groupBy("airline_name")\
+             .agg(expr("slice(sort_array(collect_list(struct(number_of_flights, aircraft_name)), false), 1, 3)").alias("top_aircrafts"))
 
-df_q6 = spark.sql("""
-    SELECT airline_name, aircraft_name, number_of_flights
-    FROM (
-        SELECT airline_name, aircraft_name, number_of_flights,
-        ROW_NUMBER() OVER (PARTITION BY airline_name ORDER BY number_of_flights DESC) AS row_number
-        FROM df_q6
-    )
-    WHERE row_number <= 3
-""")
+df_q6 = df_q6.select("airline_name", F.explode("top_aircrafts").alias("top_aircraft"))\
+             .select("airline_name", "top_aircraft.aircraft_name", "top_aircraft.number_of_flights")
 
 #%%
 
 # Question Bonus: Quel aéroport a la plus grande différence entre le nombre de vol sortant et le nombre de vols entrants ?
 
-df_qb_1 = spark.sql("""
-    SELECT origin_airport_iata, COUNT(id) AS nb_departures
-    FROM df
-    GROUP BY origin_airport_iata
-""")
-                    
-df_qb_2 = spark.sql("""
-    SELECT destination_airport_iata, COUNT(id) AS nb_arrivals
-    FROM df
-    GROUP BY destination_airport_iata
-""")
+# Chaque vol compte une fois comme départ de son origine et une fois comme arrivée de sa destination:
+# une seule agrégation remplace les deux GROUP BY et leur jointure
+df_qb = df.select(F.col("origin_airport_iata").alias("airport_iata"), F.lit(1).alias("departure"), F.lit(0).alias("arrival"))\
+          .union(df.select(F.col("destination_airport_iata").alias("airport_iata"), F.lit(0).alias("departure"), F.lit(1).alias("arrival")))
 
 # Clean des valeurs nuls
-df_qb_1 = df_qb_1.filter(df_qb_1.origin_airport_iata.isNotNull())
-df_qb_2 = df_qb_2.filter(df_qb_2.destination_airport_iata.isNotNull())
+df_qb = df_qb.filter(df_qb.airport_iata.isNotNull())
 
-df_qb = df_qb_1.join(df_qb_2, df_qb_1.origin_airport_iata == df_qb_2.destination_airport_iata)
+df_qb = df_qb.groupBy("airport_iata")\
+             .agg(F.sum("departure").alias("nb_departures"), F.sum("arrival").alias("nb_arrivals"))
 
+# Seuls les aéroports avec des départs et des arrivées sont comparés, comme avec l'ancienne jointure interne
+df_qb = df_qb.filter((df_qb.nb_departures > 0) & (df_qb.nb_arrivals > 0))
 
 df_qb = df_qb.withColumn("difference", expr("abs(nb_departures - nb_arrivals)"))
-df_qb = df_qb.drop("origin_airport_iata", "nb_departures", "nb_arrivals")\
-             .withColumnRenamed("destination_airport_iata", "airport_iata")
+df_qb = df_qb.drop("nb_departures", "nb_arrivals")
 
-df_qb.createOrReplaceTempView("df_qb")
-
-
-df_qb = spark.sql("""
-    SELECT * FROM df_qb
-    WHERE difference = (SELECT MAX(difference) FROM df_qb)
-""")
+# Fenêtre sur le résultat agrégé (petit) pour garder les ex aequo sans relire df
+df_qb = df_qb.withColumn("max_difference", F.max("difference").over(Window.partitionBy()))
+df_qb = df_qb.filter(df_qb.difference == df_qb.max_difference).drop("max_difference")
 
 #%%
+# Les 7 résultats sont petits: les jobs sont soumis en même temps au scheduler depuis des threads du driver
+# au lieu d'enchaîner un aller-retour par show(), et rapatriés via Arrow
 
-# Clean des vues
+questions = {"Q1": df_q1, "Q2": df_q2, "Q3": df_q3, "Q4": df_q4, "Q5": df_q5, "Q6": df_q6, "QB": df_qb}
 
-spark.catalog.dropTempView("df")
-spark.catalog.dropTempView("df_active")
-spark.catalog.dropTempView("df_q2")
-spark.catalog.dropTempView("df_q6")
-spark.catalog.dropTempView("df_qb")
+with ThreadPoolExecutor(max_workers=len(questions)) as executor:
+    results = dict(zip(questions, executor.map(DataFrame.toPandas, questions.values())))
 
 #%%
 # Affichage Q1
-df_q1.show()
+print(results["Q1"])
 
 #%%
 # Affichage Q2
-df_q2.show()
+print(results["Q2"])
 
 #%%
 # Affichage Q3
-df_q3.show()
+print(results["Q3"])
 
 #%%
 # Affichage Q4
-df_q4.show()
+print(results["Q4"])
 
 #%%
 # Affichage Q5
-df_q5.show()
+print(results["Q5"])
 
 #%%
 # Affichage Q6
-df_q6.show()
+print(results["Q6"])
 
 #%%
 # Affichage QB
-df_qb.show()
\ No newline at end of file
+print(results["QB"])
+
+#%%
+# Libération du cache
+df_q2_base.unpersist()
+df_active.unpersist()
+df.unpersist()